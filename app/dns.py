@@ -4,131 +4,200 @@ from __future__ import annotations
 
 import dataclasses
 import enum
+import functools
 import math
-import re
+import struct
 import typing
 
 
-_TBF = typing.TypeVar('_TBF', bound='BitField')
+_T = typing.TypeVar('_T')
 
 
-def bit_field(width, **kwargs):
-    """Create a bit field with given *width*."""
-    return dataclasses.field(metadata={'width': width}, **kwargs)
+class ParseError(ValueError):
+    """A byte buffer does not contain a valid DNS packet."""
 
 
-def _check_bit_fields(obj, allow_non_bitfield: bool = True) -> None:
-    for field in dataclasses.fields(obj):
-        if 'width' not in field.metadata:
-            if allow_non_bitfield:
-                continue
-            raise TypeError(f'{field.name} is not annotated with bit field width')
-        max_value = 2 ** field.metadata['width'] - 1
-        value = getattr(obj, field.name)
-        if value < 0 or value > max_value:
-            raise ValueError(
-                f'{field.name} ({value}) is out of bounds [0, {max_value}]')
+# Lookup tables for label validation: labels must start and end with a letter, and
+# may contain letters, digits, and hyphens in between.
+_LABEL_LETTERS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+_LABEL_VALID_END = bytes(c in _LABEL_LETTERS for c in range(256))
+_LABEL_INVALID = bytes(c for c in range(256)
+                       if c not in _LABEL_LETTERS + b'0123456789-')
 
 
-class BitField:
-    """A mixin for dataclass of bit fields."""
+def bit_field(width, **kwargs):
+    """Create a bit field with given *width*."""
+    return dataclasses.field(metadata={'width': width}, **kwargs)
 
-    def __post_init__(self) -> None:
-        """Validate fields fit within specified width."""
-        _check_bit_fields(self, allow_non_bitfield=False)
 
-    @classmethod
-    @property
-    def total_bytes(cls) -> int:
-        """Calculate size of bitfield in bytes."""
-        total_width = sum(field.metadata['width'] for field in dataclasses.fields(cls))
-        return math.ceil(total_width / 8)
+@functools.cache
+def _bit_limits(cls: type) -> tuple[tuple[str, int, int], ...]:
+    """
+    Get the name, maximum value, and invalid bits of each bit field of a dataclass.
 
-    @classmethod
-    def unpack(cls: type[_TBF], buf: bytes, offset: int) -> tuple[_TBF, int]:
-        """
-        Unpack a bitfield out of a byte buffer.
+    Maximum values are all ones, so a value is out of bounds exactly when it has any of
+    the (inverted) invalid bits set, including the sign.
+    """
+    return tuple((field.name, 2 ** field.metadata['width'] - 1,
+                  ~(2 ** field.metadata['width'] - 1))
+                 for field in dataclasses.fields(cls) if 'width' in field.metadata)
 
-        Parameters
-        ----------
-        buf
-            The byte buffer to unpack.
-        offset
-            The offset in the byte buffer at which to start unpacking this struct.
 
-        Returns
-        -------
-        bitfield
-            The bit field struct.
-        offset
-            The offset of the next byte after this struct.
-        """
-        if len(buf[offset:]) < cls.total_bytes:
+def _check_bit_fields(obj) -> None:
+    for name, max_value, invalid in _bit_limits(type(obj)):
+        value = getattr(obj, name)
+        if value & invalid:
             raise ValueError(
-                f'Buffer of length {len(buf) - offset} is smaller than expected '
-                f'bitfield size ({cls.total_bytes})')
+                f'{name} ({value}) is out of bounds [0, {max_value}]')
 
-        result = {}
-        temp_value = 0
-        current_width = 0
-        for field in dataclasses.fields(cls):
-            width = field.metadata['width']
 
-            # Grab enough data from the buffer for this field.
-            while current_width < width:
-                temp_value <<= 8
-                temp_value |= buf[offset]
-                current_width += 8
-                offset += 1
+def _make_unchecked(cls: type[_T], **values) -> _T:
+    """
+    Create a dataclass instance from trusted *values*, skipping validation.
 
-            # Get this field's bits by shifting (and truncating) extra bits.
-            result[field.name] = temp_value >> (current_width - width)
+    This is only intended for values that cannot be out of bounds, such as those masked
+    out of a byte buffer.
+    """
+    self = object.__new__(cls)
+    for name, value in values.items():
+        object.__setattr__(self, name, value)
+    return self
 
-            # Calculate a mask with the remaining bits only.
-            mask = 2 ** (current_width - width) - 1
 
-            # Remove this field's bits from the temporary value.
-            temp_value &= mask
-            current_width -= width
+class BitField:
+    """
+    A mixin for dataclass of bit fields.
 
-        return cls(**result), offset
+    Subclasses get pack, unpack, and validation methods generated for their layout.
+    """
 
-    def pack(self) -> bytes:
+    __slots__ = ()
+
+    #: The name and width of each bit field, in packing order.
+    _bit_layout: typing.ClassVar[tuple[tuple[str, int], ...]] = ()
+    #: The size of the packed bit fields in bytes.
+    total_bytes: typing.ClassVar[int] = 0
+    #: The name, shift and mask of each bit field within the packed integer.
+    _bit_shifts: typing.ClassVar[tuple[tuple[str, int, int], ...]] = ()
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        """Cache the bit field layout of the subclass."""
+        super().__init_subclass__(**kwargs)
+        # This runs before the dataclass decorator has processed the class, so the
+        # declared fields are still available as class attributes. If the class has
+        # been re-created (e.g., to add slots), then they are in the dataclass fields.
+        fields = dict(getattr(cls, '__dataclass_fields__', {}))
+        fields.update((name, value) for name, value in vars(cls).items()
+                      if isinstance(value, dataclasses.Field))
+        cls._bit_layout = tuple((name, field.metadata['width'])
+                                for name, field in fields.items()
+                                if 'width' in field.metadata)
+        # Check for non-bit fields once here instead of on every instantiation.
+        bit_names = {name for name, _ in cls._bit_layout}
+        for name, annotation in vars(cls).get('__annotations__', {}).items():
+            if name not in bit_names and 'ClassVar' not in str(annotation):
+                raise TypeError(f'{name} is not annotated with bit field width')
+        cls.total_bytes = math.ceil(sum(width for _, width in cls._bit_layout) / 8)
+        # Fields are packed from the most significant bit, with any padding at the end.
+        shift = cls.total_bytes * 8
+        shifts = []
+        for name, width in cls._bit_layout:
+            shift -= width
+            shifts.append((name, shift, 2**width - 1))
+        cls._bit_shifts = tuple(shifts)
+        if cls._bit_layout:
+            cls._compile_codec()
+
+    @classmethod
+    def _compile_codec(cls) -> None:
         """
-        Pack bit fields into a bytes object.
+        Generate straight-line pack, unpack, and validation methods for this layout.
 
-        Bit fields are packed in big endian order. If the total number of bits is not a
-        multiple of 8, then the last byte will by filled with zeroes.
+        Subclasses that define their own pack, unpack, or __post_init__ methods keep
+        them.
         """
-        result = []
-        value = 0
-        current_width = 0
-        for field in dataclasses.fields(self):
-            width = field.metadata['width']
-            bits = getattr(self, field.name)
-
-            # Append this bit field to the current integer.
-            value <<= width
-            value |= bits
-            current_width += width
-
-            # When we have enough bits, turn them into bytes.
-            # This is probably inefficient if we have a field that is many multiples of
-            # 8 bits wide, but whatever.
-            while current_width >= 8:
-                current_byte = value >> (current_width - 8)  # Grab top 8 bits.
-                current_width -= 8
-                value &= 2**current_width - 1  # Mask out the top 8 bits.
-                result.append(current_byte)
-
-        if current_width > 0:
-            current_byte = value << (8 - current_width)  # Shift final bits to MSB.
-            result.append(current_byte)
-
-        return bytes(result)
-
-
-@dataclasses.dataclass(kw_only=True)
+        size = cls.total_bytes
+        fields = ', '.join(f'{name}=(value >> {shift}) & {mask}'
+                           for name, shift, mask in cls._bit_shifts)
+        bits = ' | '.join(f'self.{name} << {shift}'
+                          for name, shift, _ in cls._bit_shifts)
+        checks = ''.join(f'''
+    if self.{name} & {~mask}:
+        raise ValueError(f'{name} ({{self.{name}}}) is out of bounds [0, {mask}]')'''
+                         for name, _, mask in cls._bit_shifts)
+        source = f'''
+def unpack(cls, buf, offset):
+    """
+    Unpack a bitfield out of a byte buffer.
+
+    Parameters
+    ----------
+    buf
+        The byte buffer to unpack.
+    offset
+        The offset in the byte buffer at which to start unpacking this struct.
+
+    Returns
+    -------
+    bitfield
+        The bit field struct.
+    offset
+        The offset of the next byte after this struct.
+    """
+    if len(buf) - offset < {size}:
+        raise ParseError(
+            f'Buffer of length {{len(buf) - offset}} is smaller than expected '
+            f'bitfield size ({size})')
+    value = int.from_bytes(buf[offset:offset + {size}])
+    return _make_unchecked(cls, {fields}), offset + {size}
+
+def pack(self):
+    """
+    Pack bit fields into a bytes object.
+
+    Bit fields are packed in big endian order. If the total number of bits is not a
+    multiple of 8, then the last byte will by filled with zeroes.
+    """
+    return ({bits}).to_bytes({size})
+
+def __post_init__(self):
+    """Validate fields fit within specified width."""{checks}
+'''
+        namespace: dict[str, typing.Any] = {}
+        exec(source, globals(), namespace)
+        if 'unpack' not in vars(cls):
+            cls.unpack = classmethod(namespace['unpack'])
+        if 'pack' not in vars(cls):
+            cls.pack = namespace['pack']
+        if '__post_init__' not in vars(cls):
+            cls.__post_init__ = namespace['__post_init__']
+
+
+# The DNS header layout is fixed, so it uses a specialized codec instead of the generic
+# bit field one; the flags are packed into one 16-bit word by hand.
+_HEADER = struct.Struct('!HHHHHH')
+
+
+def pack_header(packet_identifier: int, *, query_response: int = 0,
+                operation_code: int = 0, authoritative_answer: int = 0,
+                truncation: int = 0, recursion_desired: int = 0,
+                recursion_available: int = 0, reserved: int = 0, response_code: int = 0,
+                question_count: int = 0, answer_record_count: int = 0,
+                authority_record_count: int = 0, additional_record_count: int = 0,
+                ) -> bytes:
+    """
+    Pack the fields of a DNS header into a bytes object, without creating a `Header`.
+
+    The fields are not checked, so must already fit within their bit fields.
+    """
+    flags = (query_response << 15 | operation_code << 11 | authoritative_answer << 10 |
+             truncation << 9 | recursion_desired << 8 | recursion_available << 7 |
+             reserved << 4 | response_code)
+    return _HEADER.pack(packet_identifier, flags, question_count, answer_record_count,
+                        authority_record_count, additional_record_count)
+
+
+@dataclasses.dataclass(kw_only=True, slots=True)
 class Header(BitField):
     """A DNS header."""
 
@@ -146,6 +215,134 @@ class Header(BitField):
     authority_record_count: int = bit_field(16, default=0)
     additional_record_count: int = bit_field(16, default=0)
 
+    @classmethod
+    def unpack(cls, buf: bytes | memoryview, offset: int) -> tuple[Header, int]:
+        """
+        Unpack a DNS header out of a byte buffer.
+
+        Parameters
+        ----------
+        buf
+            The byte buffer to unpack.
+        offset
+            The offset in the byte buffer at which to start unpacking this header.
+
+        Returns
+        -------
+        header
+            The DNS header.
+        offset
+            The offset of the next byte after this header.
+        """
+        if len(buf) - offset < cls.total_bytes:
+            raise ParseError(
+                f'Buffer of length {len(buf) - offset} is smaller than expected '
+                f'bitfield size ({cls.total_bytes})')
+        (packet_identifier, flags, question_count, answer_record_count,
+         authority_record_count, additional_record_count) = \
+            _HEADER.unpack_from(buf, offset)
+        header = _make_unchecked(
+            cls,
+            packet_identifier=packet_identifier,
+            query_response=flags >> 15,
+            operation_code=(flags >> 11) & 0b1111,
+            authoritative_answer=(flags >> 10) & 1,
+            truncation=(flags >> 9) & 1,
+            recursion_desired=(flags >> 8) & 1,
+            recursion_available=(flags >> 7) & 1,
+            reserved=(flags >> 4) & 0b111,
+            response_code=flags & 0b1111,
+            question_count=question_count,
+            answer_record_count=answer_record_count,
+            authority_record_count=authority_record_count,
+            additional_record_count=additional_record_count,
+        )
+        return header, offset + cls.total_bytes
+
+    def pack(self) -> bytes:
+        """Pack a DNS header into a bytes object."""
+        return pack_header(
+            self.packet_identifier,
+            query_response=self.query_response,
+            operation_code=self.operation_code,
+            authoritative_answer=self.authoritative_answer,
+            truncation=self.truncation,
+            recursion_desired=self.recursion_desired,
+            recursion_available=self.recursion_available,
+            reserved=self.reserved,
+            response_code=self.response_code,
+            question_count=self.question_count,
+            answer_record_count=self.answer_record_count,
+            authority_record_count=self.authority_record_count,
+            additional_record_count=self.additional_record_count,
+        )
+
+
+def _unpack_labels(buf: bytes | memoryview, offset: int,
+                   memo: dict[int, tuple[bytes, ...]] | None = None,
+                   ) -> tuple[list[bytes], int]:
+    """
+    Unpack the raw labels of a label sequence out of a byte buffer.
+
+    This is the inner loop of `LabelSequence.unpack`; pointers are followed by jumping
+    to their target, so no intermediate label sequences are created. If a *memo* is
+    given, pointers to already-decoded names are resolved from it, and it is updated
+    with every name suffix decoded here.
+    """
+    # TODO: Check buffer size.
+    name: list[bytes] = []
+    append = name.append
+    # Offsets that have already been visited, in order to prevent loops. Pointer
+    # chains are short, so a list is cheaper than a set here.
+    visited = [offset]
+    end = None
+    starts: list[int] = []
+    while (size := buf[offset]) != 0:
+        if flags := size & 0b11000000:
+            if flags != 0b11000000:
+                raise ParseError(f'Label pointer uses unknown flags {flags}')
+            # This is a pointer to another location; mask out the top flag bits.
+            pointer = (size & 0b00111111) << 8 | buf[offset + 1]
+            if pointer in visited:
+                raise ParseError('Label sequence contains a loop')
+            if pointer >= len(buf):
+                raise ParseError(
+                    f'Label pointer ({pointer}) exceeds buffer size ({len(buf)})')
+            visited.append(pointer)
+            if end is None:
+                # The sequence ends after the first pointer (which is two bytes).
+                end = offset + 2
+            if memo is not None and (suffix := memo.get(pointer)) is not None:
+                name.extend(suffix)
+                break
+            offset = pointer
+            continue
+        if memo is not None:
+            starts.append(offset)
+        # Add 1 everywhere to skip the size byte.
+        append(bytes(buf[offset + 1:offset + size + 1]))
+        offset += size + 1
+    if memo is not None:
+        for i, start in enumerate(starts):
+            memo[start] = tuple(name[i:])
+    return name, offset + 1 if end is None else end
+
+
+# The length prefix of every possible label, so that none need to be created.
+_LABEL_LENGTHS = tuple(bytes((size, )) for size in range(64))
+
+
+# The same names (e.g., those of a zone) tend to be packed over and over, even if from
+# different label sequence instances, so share their packed form.
+@functools.lru_cache(maxsize=1024)
+def _pack_labels(labels: tuple[bytes, ...]) -> bytes:
+    parts = []
+    for name in labels:
+        parts.append(_LABEL_LENGTHS[len(name)])
+        parts.append(name)
+    parts.append(b'\x00')
+    return b''.join(parts)
+
 
 class LabelSequence(tuple[bytes, ...]):
     """A DNS label sequence."""
@@ -157,13 +354,27 @@ class LabelSequence(tuple[bytes, ...]):
             if len(name) > 63:
                 raise ValueError(
                     f'Name entry {name!r} may not be longer than 63 characters')
-            if not re.fullmatch(rb'[A-Za-z]([A-Za-z0-9-]*[A-Za-z])?', name):
+            if (not name or not _LABEL_VALID_END[name[0]] or
+                    not _LABEL_VALID_END[name[-1]]):
                 raise ValueError(f'Name entry {name!r} does not obey DNS rules')
+        # Check the characters of all labels at once, and only look for the offending
+        # label if that fails.
+        joined = b''.join(self)
+        if len(joined.translate(None, _LABEL_INVALID)) != len(joined):
+            for name in self:
+                if len(name.translate(None, _LABEL_INVALID)) != len(name):
+                    raise ValueError(f'Name entry {name!r} does not obey DNS rules')
         return self
 
     @classmethod
-    def unpack(cls, buf: bytes, offset: int,
-               other_offsets: set[int] | None = None) -> tuple[LabelSequence, int]:
+    def _from_trusted(cls, names) -> LabelSequence:
+        """Create a label sequence from trusted *names*, skipping validation."""
+        return tuple.__new__(cls, names)
+
+    @classmethod
+    def unpack(cls, buf: bytes | memoryview, offset: int,
+               memo: dict[int, tuple[bytes, ...]] | None = None,
+               ) -> tuple[LabelSequence, int]:
         """
         Unpack a label sequence out of a byte buffer.
 
@@ -174,9 +385,9 @@ class LabelSequence(tuple[bytes, ...]):
         offset
             The offset in the byte buffer at which to start unpacking this label
             sequence.
-        other_offsets
-            A set to track offsets that have already been checked, in order to prevent
-            loops.
+        memo
+            A cache of label sequences already decoded from this buffer, keyed by
+            their offset, which is shared by all names in a packet.
 
         Returns
         -------
@@ -185,40 +396,24 @@ class LabelSequence(tuple[bytes, ...]):
         offset
             The offset of the next byte after this label sequence.
         """
-        # TODO: Check buffer size.
-        if other_offsets is None:
-            other_offsets = {offset}
-        name: list[bytes] = []
-        while (size := buf[offset]) != 0:
-            if flags := size & 0b11000000:
-                if flags != 0b11000000:
-                    raise ValueError(f'Label pointer uses unknown flags {flags}')
-                # This is a pointer to another location; mask out the top flag bits.
-                pointer = int.from_bytes(buf[offset:offset + 2]) & 0b00111111_11111111
-                if pointer in other_offsets:
-                    raise ValueError('Label sequence contains a loop')
-                if pointer > len(buf):
-                    raise ValueError(
-                        f'Label pointer ({pointer}) exceeds buffer size ({len(buf)})')
-                other_offsets.add(pointer)
-                name.extend(LabelSequence.unpack(buf, pointer)[0])
-                # Two bytes used for pointer, but we add one below for the last size
-                # byte, so only add one here.
-                offset += 1
-                break
-            # Add 1 everywhere to skip the size byte.
-            label = buf[offset + 1:offset + size + 1]
-            offset += size + 1
-            name.append(label)
-        return cls(name), offset + 1
+        name, offset = _unpack_labels(buf, offset, memo)
+        return _intern_labels(tuple(name)), offset
+
+    @functools.cached_property
+    def _packed(self) -> bytes:
+        return _pack_labels(self)
 
     def pack(self) -> bytes:
         """Pack a label sequence into a bytes object."""
-        result = []
-        for name in self:
-            result += [len(name), *name]
-        result += [0x00]
-        return bytes(result)
+        # Label sequences are immutable, so the packed form only needs computing once.
+        return self._packed
+
+
+# Popular names are received over and over, so share one label sequence (and its cached
+# packed form) between all of their occurrences.
+@functools.lru_cache(maxsize=4096)
+def _intern_labels(labels: tuple[bytes, ...]) -> LabelSequence:
+    return LabelSequence._from_trusted(labels)
 
 
 class QuestionType(enum.IntEnum):
@@ -264,20 +459,36 @@ class QuestionClass(enum.IntEnum):
     ALL = 255  # Any class.
 
 
-@dataclasses.dataclass(frozen=True)
+# The fixed part of a question following its name: type and class.
+_QUESTION = struct.Struct('!HH')
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class Question:
     """A DNS question."""
 
     name: LabelSequence
-    qtype: QuestionType = bit_field(16)
-    qclass: QuestionClass = bit_field(16)
+    qtype: int = bit_field(16)
+    qclass: int = bit_field(16)
 
     def __post_init__(self):
         """Validate fields fit within question."""
         _check_bit_fields(self)
 
+    @property
+    def qtype_enum(self) -> QuestionType:
+        """The question type as an enum; raises for unknown types."""
+        return QuestionType(self.qtype)
+
+    @property
+    def qclass_enum(self) -> QuestionClass:
+        """The question class as an enum; raises for unknown classes."""
+        return QuestionClass(self.qclass)
+
     @classmethod
-    def unpack(cls, buf: bytes, offset: int) -> tuple[Question, int]:
+    def unpack(cls, buf: bytes | memoryview, offset: int,
+               memo: dict[int, tuple[bytes, ...]] | None = None,
+               ) -> tuple[Question, int]:
         """
         Unpack a question out of a byte buffer.
 
@@ -287,6 +498,9 @@ class Question:
             The byte buffer to unpack.
         offset
             The offset in the byte buffer at which to start unpacking this question.
+        memo
+            A cache of names already decoded from this buffer, keyed by their
+            offset, which is shared by all names in a packet.
 
         Returns
         -------
@@ -296,15 +510,17 @@ class Question:
             The offset of the next byte after this question.
         """
         # TODO: Check buffer size.
-        name, offset = LabelSequence.unpack(buf, offset)
-        qtype = QuestionType(int.from_bytes(buf[offset:offset + 2]))
-        qclass = QuestionClass(int.from_bytes(buf[offset + 2:offset + 4]))
-        return cls(name=name, qtype=qtype, qclass=qclass), offset + 4
+        name, offset = LabelSequence.unpack(buf, offset, memo)
+        # Types and classes are kept as plain integers, so that unknown values can
+        # still be handled.
+        qtype, qclass = _QUESTION.unpack_from(buf, offset)
+        # The fields are read from 16 bits, so they cannot be out of bounds.
+        return (_make_unchecked(cls, name=name, qtype=qtype, qclass=qclass),
+                offset + _QUESTION.size)
 
     def pack(self) -> bytes:
         """Pack a question into a bytes object."""
-        result = self.name.pack() + self.qtype.to_bytes(2) + self.qclass.to_bytes(2)
-        return result
+        return b''.join((self.name.pack(), _QUESTION.pack(self.qtype, self.qclass)))
 
 
 class AnswerType(enum.IntEnum):
@@ -341,13 +557,18 @@ class AnswerClass(enum.IntEnum):
     HS = 4  # Hesiod [Dyer 87].
 
 
-@dataclasses.dataclass
+# The fixed part of a resource record following its name: type, class, TTL and data
+# length. The TTL is unsigned, matching the bounds of its 32-bit field.
+_RESOURCE_RECORD = struct.Struct('!HHIH')
+
+
+@dataclasses.dataclass(slots=True)
 class ResourceRecord:
     """A DNS resource record."""
 
     name: LabelSequence
-    atype: AnswerType = bit_field(16)
-    aclass: AnswerClass = bit_field(16)
+    atype: int = bit_field(16)
+    aclass: int = bit_field(16)
     ttl: int = bit_field(32)
     data: bytes = b''
 
@@ -355,8 +576,20 @@ class ResourceRecord:
         """Validate fields fit within resource record."""
         _check_bit_fields(self)
 
+    @property
+    def atype_enum(self) -> AnswerType:
+        """The record type as an enum; raises for unknown types."""
+        return AnswerType(self.atype)
+
+    @property
+    def aclass_enum(self) -> AnswerClass:
+        """The record class as an enum; raises for unknown classes."""
+        return AnswerClass(self.aclass)
+
     @classmethod
-    def unpack(cls, buf: bytes, offset: int) -> tuple[ResourceRecord, int]:
+    def unpack(cls, buf: bytes | memoryview, offset: int,
+               memo: dict[int, tuple[bytes, ...]] | None = None,
+               ) -> tuple[ResourceRecord, int]:
         """
         Unpack a DNS resource record out of a byte buffer.
 
@@ -367,6 +600,9 @@ class ResourceRecord:
         offset
             The offset in the byte buffer at which to start unpacking this resource
             record.
+        memo
+            A cache of names already decoded from this buffer, keyed by their
+            offset, which is shared by all names in a packet.
 
         Returns
         -------
@@ -375,27 +611,32 @@ class ResourceRecord:
         offset
             The offset of the next byte after this resource record.
         """
-        name, offset = LabelSequence.unpack(buf, offset)
-        atype = AnswerType(int.from_bytes(buf[offset:offset + 2]))
-        aclass = AnswerClass(int.from_bytes(buf[offset + 2:offset + 4]))
-        ttl = int.from_bytes(buf[offset + 4:offset + 8], signed=True)
-        rdlen = int.from_bytes(buf[offset + 8:offset + 10])
-        data = buf[offset + 10:offset + rdlen + 10]
-        return (cls(name=name, atype=atype, aclass=aclass, ttl=ttl, data=data),
-                offset + rdlen + 10)
+        name, offset = LabelSequence.unpack(buf, offset, memo)
+        atype, aclass, ttl, rdlen = _RESOURCE_RECORD.unpack_from(buf, offset)
+        offset += _RESOURCE_RECORD.size
+        end = offset + rdlen
+        if end > len(buf):
+            # Slicing would silently return fewer bytes.
+            raise ParseError(
+                f'Record data of length {len(buf) - offset} is smaller than expected '
+                f'size ({rdlen})')
+        data = bytes(buf[offset:end])
+        # The fields are read as unsigned integers of the same width as their bit
+        # fields, so they cannot be out of bounds.
+        return (_make_unchecked(cls, name=name, atype=atype, aclass=aclass, ttl=ttl,
+                                data=data),
+                end)
 
     def pack(self) -> bytes:
         """Pack a DNS resource record into a bytes object."""
-        result = (
-            self.name.pack() +
-            self.atype.to_bytes(2) + self.aclass.to_bytes(2) +
-            self.ttl.to_bytes(4, signed=True) +
-            len(self.data).to_bytes(2) + self.data
-        )
-        return result
+        return b''.join((
+            self.name.pack(),
+            _RESOURCE_RECORD.pack(self.atype, self.aclass, self.ttl, len(self.data)),
+            self.data,
+        ))
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Packet:
     """A DNS packet."""
 
@@ -418,7 +659,7 @@ class Packet:
             )
 
     @classmethod
-    def unpack(cls, buf: bytes, offset: int = 0) -> tuple[Packet, int]:
+    def unpack(cls, buf: bytes | memoryview, offset: int = 0) -> tuple[Packet, int]:
         """
         Unpack a DNS packet out of a byte buffer.
 
@@ -436,38 +677,55 @@ class Packet:
         offset
             The offset of the next byte after this packet.
         """
-        header, offset = Header.unpack(buf, offset)
-
-        questions = []
-        for i in range(header.question_count):
-            question, offset = Question.unpack(buf, offset)
-            questions.append(question)
-
-        answers = []
-        for i in range(header.answer_record_count):
-            rr, offset = ResourceRecord.unpack(buf, offset)
-            answers.append(rr)
+        # Slicing a memoryview does not copy, so only the labels and record data that
+        # are kept get copied out of the buffer.
+        buf = memoryview(buf)
+        try:
+            header, offset = Header.unpack(buf, offset)
+            # Names in a packet are often compressed to point at the same location, so
+            # only decode each one once.
+            memo: dict[int, tuple[bytes, ...]] = {}
+
+            questions: list[Question] = []
+            question_unpack = Question.unpack
+            question_append = questions.append
+            for _ in range(header.question_count):
+                question, offset = question_unpack(buf, offset, memo)
+                question_append(question)
+
+            answers: list[ResourceRecord] = []
+            record_unpack = ResourceRecord.unpack
+            record_append = answers.append
+            for _ in range(header.answer_record_count):
+                rr, offset = record_unpack(buf, offset, memo)
+                record_append(rr)
+        except (IndexError, struct.error) as e:
+            raise ParseError(f'Packet is truncated: {e}') from e
 
         return (cls(header=header, questions=tuple(questions), answers=tuple(answers)),
                 offset)
 
     def pack(self) -> bytes:
         """Pack a DNS packet into a bytes object."""
-        result = self.header.pack()
-        for question in self.questions:
-            result += question.pack()
-        for record in self.answers:
-            result += record.pack()
-        return result
+        parts = [self.header.pack()]
+        parts.extend(question.pack() for question in self.questions)
+        parts.extend(record.pack() for record in self.answers)
+        return b''.join(parts)
 
-    def print(self, indent_level=0, tab_size=4):
-        """Print out a DNS packet at a given *indent_level* and *tab_size*."""
+    def format(self, indent_level=0, tab_size=4) -> str:
+        """Format a DNS packet at a given *indent_level* and *tab_size*."""
         tab = ' ' * tab_size
         initial = tab * indent_level
-        print(f'{initial}{self.header}')
+        lines = [f'{initial}{self.header}']
 
         for i, question in enumerate(self.questions):
-            print(f'{initial}{tab}Question {i}: {question}')
+            lines.append(f'{initial}{tab}Question {i}: {question}')
 
         for i, record in enumerate(self.answers):
-            print(f'{initial}{tab}Answer {i}: {record}')
+            lines.append(f'{initial}{tab}Answer {i}: {record}')
+
+        return '\n'.join(lines)
+
+    def print(self, indent_level=0, tab_size=4):
+        """Print out a DNS packet at a given *indent_level* and *tab_size*."""
+        print(self.format(indent_level=indent_level, tab_size=tab_size))
@@ -2,52 +2,151 @@
 
 import argparse
 import dataclasses
+import logging
+import multiprocessing
 import random
+import selectors
 import socket
+import struct
+import time
 import typing
 
 from . import dns
 
 
+log = logging.getLogger(__name__)
+
+# Everything in the default answer following its name: type, class, TTL, and data.
+_DEFAULT_ANSWER = struct.Struct('!HHIH4s')
+# The response code for a request that could not be resolved.
+_SERVER_FAILURE = 2
+# Seconds to wait for the upstream resolver to answer a forwarded question.
+_UPSTREAM_TIMEOUT = 5.0
+# Attempts at drawing a packet identifier that is not in flight, before giving up.
+_MAX_ID_ATTEMPTS = 32
+# The most datagrams to receive from a socket each time it is ready.
+_RECEIVE_BATCH_SIZE = 64
+# The requested size of kernel socket buffers, so that bursts are not dropped; Linux
+# caps this to the net.core.rmem_max and net.core.wmem_max sysctls.
+_SOCKET_BUFFER_SIZE = 4 << 20
+
+
+def _pack_response_header(request: dns.Header, response_code: int,
+                          question_count: int, answer_count: int) -> bytes:
+    """Pack the header of a response to a *request*."""
+    # The request is already parsed, so its fields are within bounds.
+    return dns.pack_header(request.packet_identifier, query_response=1,
+                           operation_code=request.operation_code,
+                           recursion_desired=request.recursion_desired,
+                           response_code=response_code, question_count=question_count,
+                           answer_record_count=answer_count)
+
+
+def _pack_default_answer(index: int) -> bytes:
+    """Pack everything but the name of the default answer to question *index*."""
+    return _DEFAULT_ANSWER.pack(dns.AnswerType.A, dns.AnswerClass.IN, 123 + 10 * index,
+                                4, b'\x01\x02\x03\x04')
+
+
+# Default answers only differ by name and TTL (which depends on the question index), so
+# the rest is precomputed for as many questions as fit in a 512-byte datagram.
+_DEFAULT_ANSWERS = tuple(_pack_default_answer(i) for i in range(100))
+
+
+def _pack_default_response(request: dns.Packet,
+                           question_section: bytes | None = None) -> bytes:
+    """
+    Pack the response to a *request* when there is no upstream resolver.
+
+    Every question is answered with a fixed A record, so its bytes are packed directly
+    instead of through a `dns.ResourceRecord`. If given, the *question_section* of the
+    request is echoed as is instead of packing its questions again.
+    """
+    questions = request.questions
+    # Anything but a standard query (opcode 0) is not implemented (code 4).
+    parts = [_pack_response_header(request.header,
+                                   (request.header.operation_code != 0) * 4,
+                                   len(questions), len(questions))]
+    if question_section is None:
+        parts.extend(question.pack() for question in questions)
+    else:
+        parts.append(question_section)
+    answers = _DEFAULT_ANSWERS
+    if len(questions) > len(answers):
+        answers += tuple(_pack_default_answer(i)
+                         for i in range(len(answers), len(questions)))
+    for question, answer in zip(questions, answers):
+        parts.append(question.name.pack())
+        parts.append(answer)
+    return b''.join(parts)
+
+
+def _log_packet(title: str, packet: dns.Packet) -> None:
+    """Log a *packet* under a *title*, only formatting it if debugging is enabled."""
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('%s\n%s\n%s\n', title, '=' * len(title),
+                  packet.format(indent_level=1))
+
+
 class OpenRequest:
     """Helper class to track an open request."""
 
-    def __init__(self, source: tuple[str, int], request: dns.Packet):
+    __slots__ = ('source', 'request', 'question_section', 'response_code', 'answers',
+                 '_pending')
+
+    def __init__(self, source: tuple[str, int], request: dns.Packet,
+                 question_section: bytes | None = None):
         self.source = source
         self.request = request
+        # The raw question section of the request, if known, to echo in the response.
+        self.question_section = question_section
         self.response_code = 0
-        self.answers: dict[dns.Question, dns.ResourceRecord | None] = {
-            question: None for question in request.questions}
-
-    def __hash__(self):
-        return hash((self.source, self.request.header.packet_identifier))
+        # The answers to each question, by position, or None if not yet answered.
+        self.answers: list[tuple[dns.ResourceRecord, ...] | None] = [
+            None] * len(request.questions)
+        # The number of questions still waiting for an answer.
+        self._pending = len(self.answers)
 
     @property
     def is_complete(self) -> bool:
         """Whether this request is complete."""
-        return (self.response_code != 0 or
-                all(value is not None for value in self.answers.values()))
+        return self.response_code != 0 or self._pending == 0
 
-    def add_response(self, response: dns.Packet) -> None:
-        """Add a response to this open request."""
+    def add_answers(self, index: int, answers: tuple[dns.ResourceRecord, ...]) -> None:
+        """Set the *answers* to the question at *index* of this open request."""
+        if self.answers[index] is None:
+            self._pending -= 1
+        self.answers[index] = answers
+
+    def add_response(self, index: int, response: dns.Packet) -> None:
+        """Add a *response* to the question at *index* of this open request."""
         if response.header.response_code != 0:
             self.response_code = response.header.response_code
-            self.answers.clear()
             return
-        for answer in response.answers:
-            question = dns.Question(answer.name, dns.QuestionType(answer.atype),
-                                    dns.QuestionClass(answer.atype))
-            self.answers[question] = answer
+        self.add_answers(index, response.answers)
+
+    @property
+    def effective_response_code(self) -> int:
+        """The response code to use, if this request is complete."""
+        # An error from upstream takes precedence. Otherwise, anything but a standard
+        # query (opcode 0) is not implemented (code 4), which (opcode != 0) * 4
+        # computes arithmetically instead of with another branch.
+        return self.response_code or (self.request.header.operation_code != 0) * 4
+
+    def _records(self) -> list[dns.ResourceRecord]:
+        """All answer records in question order, if this request is complete."""
+        if self.response_code != 0:
+            # An error from upstream discards any other answers.
+            return []
+        answers = typing.cast(list[tuple[dns.ResourceRecord, ...]],  # When complete.
+                              self.answers)
+        return [record for records in answers for record in records]
 
     def to_response(self) -> dns.Packet:
         """Convert to a response packet, if this request is complete."""
         if not self.is_complete:
             raise ValueError('Cannot convert open request to response')
-        response_code = (
-            self.response_code if self.response_code != 0 else
-            0 if self.request.header.operation_code == 0 else 4)
-        answers = typing.cast(dict[dns.Question, dns.ResourceRecord],  # When complete.
-                              self.answers)
+        response_code = self.effective_response_code
         response = dns.Packet(
             header=dns.Header(packet_identifier=self.request.header.packet_identifier,
                               query_response=1,
@@ -56,107 +155,298 @@ class OpenRequest:
                               recursion_desired=self.request.header.recursion_desired,
                               recursion_available=0, response_code=response_code),
             questions=self.request.questions,
-            answers=tuple(answers.values()),
+            answers=tuple(self._records()),
             auto_set_header=True,
         )
         return response
 
+    def pack_response(self) -> bytes:
+        """
+        Pack the response to this request, if it is complete.
+
+        This is equivalent to packing `to_response`, but packs the header directly
+        with `_pack_response_header` instead of creating the intermediate packet.
+        """
+        if not self.is_complete:
+            raise ValueError('Cannot convert open request to response')
+        records = self._records()
+        parts = [_pack_response_header(self.request.header,
+                                       self.effective_response_code,
+                                       len(self.request.questions), len(records))]
+        if self.question_section is None:
+            parts.extend(question.pack() for question in self.request.questions)
+        else:
+            parts.append(self.question_section)
+        parts.extend(record.pack() for record in records)
+        return b''.join(parts)
+
+
+class Server:
+    """A DNS server, which optionally forwards questions to an upstream resolver."""
+
+    def __init__(self, address: tuple[str, int],
+                 resolver: tuple[str, int] | None = None, *,
+                 reuse_port: bool = False, upstream_timeout: float = _UPSTREAM_TIMEOUT):
+        self.selector = selectors.DefaultSelector()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUFFER_SIZE)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUFFER_SIZE)
+        if reuse_port:
+            # Let several servers bind the same address, with the kernel spreading
+            # datagrams between them.
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(address)
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ, self.handle_request)
+
+        if resolver is not None:
+            # Forwarded questions go out on their own socket, so their responses are
+            # never confused with requests, and any number may be in flight while
+            # other requests are handled.
+            self.upstream: socket.socket | None = socket.socket(socket.AF_INET,
+                                                                socket.SOCK_DGRAM)
+            self.upstream.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                     _SOCKET_BUFFER_SIZE)
+            self.upstream.connect(resolver)
+            self.upstream.setblocking(False)
+            self.selector.register(self.upstream, selectors.EVENT_READ,
+                                   self.handle_upstream_response)
+        else:
+            self.upstream = None
+
+        # Open requests, keyed by their source and packet identifier.
+        self.open_requests: dict[tuple[tuple[str, int], int], OpenRequest] = {}
+        # Forwarded questions, by packet identifier, with their original request, their
+        # index in it, and the time at which they expire. All share one timeout, so
+        # insertion order is also expiry order.
+        self.subrequests: dict[int, tuple[OpenRequest, int, float]] = {}
+        self.upstream_timeout = upstream_timeout
+
+        # Receive into one reusable buffer; parsing copies out anything it keeps.
+        self._recv_buffer = bytearray(512)
+        self._recv_view = memoryview(self._recv_buffer)
+
+    def close(self) -> None:
+        """Close the sockets of this server."""
+        self.selector.close()
+        self.socket.close()
+        if self.upstream is not None:
+            self.upstream.close()
+
+    def serve_forever(self) -> None:
+        """Handle packets until an unexpected error occurs."""
+        while True:
+            try:
+                self.handle_events()
+            except Exception:
+                log.exception('Error handling packets')
+                return
+
+    def handle_events(self, timeout: float | None = None) -> None:
+        """Wait up to *timeout* seconds (or forever) for packets, and handle them."""
+        if self.subrequests:
+            # Wake up in time to expire the oldest forwarded question.
+            _, _, deadline = next(iter(self.subrequests.values()))
+            remaining = max(deadline - time.monotonic(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        for key, _ in self.selector.select(timeout):
+            self.receive(key.fileobj, key.data)
+        self.expire_subrequests()
+
+    def expire_subrequests(self) -> None:
+        """Fail the requests of forwarded questions that were not answered in time."""
+        now = time.monotonic()
+        while self.subrequests:
+            id, (open_request, index, deadline) = next(iter(self.subrequests.items()))
+            if deadline > now:
+                return
+            del self.subrequests[id]
+            if open_request.is_complete:
+                # Already answered, because an earlier response was an error.
+                continue
+            log.warning('Timed out forwarding question to resolver: %s',
+                        open_request.request.questions[index])
+            open_request.response_code = _SERVER_FAILURE
+            self.respond(open_request)
+
+    def receive(self, sock: socket.socket, handler: typing.Callable[
+            [dns.Packet, tuple[str, int], memoryview], OpenRequest | None]) -> None:
+        """
+        Handle a batch of datagrams waiting on a (non-blocking) socket.
+
+        Parameters
+        ----------
+        sock
+            The socket to receive from.
+        handler
+            The method that handles packets received from this socket, and the bytes
+            they were parsed from, returning the request that they updated, if any.
+        """
+        # Draining several datagrams per wakeup saves a select call for each.
+        for _ in range(_RECEIVE_BATCH_SIZE):
+            try:
+                size, source = sock.recvfrom_into(self._recv_buffer)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # The connected upstream socket reports ICMP errors (e.g., nothing
+                # listening at the resolver) on its next operation; they only affect
+                # the questions in flight, so keep serving.
+                log.warning('Error receiving packet: %s', e)
+                continue
+
+            try:
+                incoming, bytes_used = dns.Packet.unpack(self._recv_view[:size])
+            except dns.ParseError as e:
+                log.warning('Dropping malformed packet from %s: %s', source, e)
+                continue
+            log.debug('Received packet from %s of %d bytes and parsed %d bytes',
+                      source, size, bytes_used)
+
+            open_request = handler(incoming, source, self._recv_view[:bytes_used])
+            if open_request is not None and open_request.is_complete:
+                self.respond(open_request)
+
+    def handle_request(self, request: dns.Packet, source: tuple[str, int],
+                       wire: memoryview) -> OpenRequest | None:
+        """Start resolving a *request* received from *source* as *wire* bytes."""
+        _log_packet('REQUEST', request)
+
+        # If only questions were parsed, echo them in the response as they were
+        # received. They start at the same offset in both, so any compressed names in
+        # them still point to the right place.
+        question_section = None
+        if request.header.answer_record_count == 0:
+            question_section = bytes(wire[dns.Header.total_bytes:])
+
+        if self.upstream is None:
+            # If no upstream resolver is configured, then answer immediately with
+            # default answers, which need no tracking.
+            response = _pack_default_response(request, question_section)
+            if log.isEnabledFor(logging.DEBUG):
+                _log_packet('RESPONSE', dns.Packet.unpack(response)[0])
+            self.send(response, source)
+            return None
+
+        open_request = OpenRequest(source, request, question_section)
+        self.open_requests[source, request.header.packet_identifier] = open_request
+
+        # Forward the request to the upstream resolver one question at a time.
+        deadline = time.monotonic() + self.upstream_timeout
+        for index, question in enumerate(request.questions):
+            # Pick an identifier that is not already in flight.
+            for _ in range(_MAX_ID_ATTEMPTS):
+                if (id := random.getrandbits(16)) not in self.subrequests:
+                    break
+            else:
+                log.warning('No free packet identifier to forward question to resolver')
+                open_request.response_code = _SERVER_FAILURE
+                break
+            self.subrequests[id] = open_request, index, deadline
+            packet = dns.Packet(
+                header=dataclasses.replace(request.header, packet_identifier=id),
+                questions=(question, ),
+                auto_set_header=True,
+            )
+            _log_packet('FORWARDED REQUEST', packet)
+            try:
+                self.forward(self.upstream, packet.pack())
+            except OSError as e:
+                log.warning('Error forwarding request to resolver: %s', e)
+                del self.subrequests[id]
+                open_request.response_code = _SERVER_FAILURE
+                break
+
+        return open_request
+
+    @staticmethod
+    def forward(upstream: socket.socket, data: bytes) -> None:
+        """Send *data* to the (connected) *upstream* resolver socket."""
+        try:
+            upstream.send(data)
+        except ConnectionRefusedError:
+            # A connected socket reports the ICMP error for an earlier datagram on its
+            # next operation, which fails without sending anything; that datagram was
+            # the one refused, so send this one again.
+            upstream.send(data)
+
+    def handle_upstream_response(self, response: dns.Packet, source: tuple[str, int],
+                                 wire: memoryview) -> OpenRequest | None:
+        """Add a *response* from the upstream resolver to its original request."""
+        _log_packet('FORWARDED RESPONSE', response)
+
+        try:
+            open_request, index, _ = self.subrequests.pop(
+                response.header.packet_identifier)
+        except KeyError:
+            log.warning('Received invalid packet from forwarded resolver')
+            return None
+
+        if open_request.is_complete:
+            # Already answered, because an earlier response was an error.
+            return None
+        open_request.add_response(index, response)
+        return open_request
+
+    def send(self, response: bytes, destination: tuple[str, int]) -> None:
+        """Send a *response* to a client, dropping it if it cannot be sent now."""
+        try:
+            self.socket.sendto(response, destination)
+        except OSError as e:
+            # The socket is non-blocking, so a full send buffer raises
+            # BlockingIOError; the client will retry, as it would for a lost packet.
+            log.warning('Dropping response to %s: %s', destination, e)
+
+    def respond(self, open_request: OpenRequest) -> None:
+        """Send the response to a complete request."""
+        if log.isEnabledFor(logging.DEBUG):
+            _log_packet('RESPONSE', open_request.to_response())
+
+        self.send(open_request.pack_response(), open_request.source)
+        key = open_request.source, open_request.request.header.packet_identifier
+        # A retransmitted request may have replaced this one; leave that one open.
+        if self.open_requests.get(key) is open_request:
+            del self.open_requests[key]
+
+
+def _serve(address: tuple[str, int], resolver: tuple[str, int] | None,
+           reuse_port: bool) -> None:
+    """Run a server until it fails; the target of each worker process."""
+    server = Server(address, resolver, reuse_port=reuse_port)
+    server.serve_forever()
+
 
 def main():
     parser = argparse.ArgumentParser(description='DNS resolver')
     parser.add_argument('-r', '--resolver',
                         help='Resolver to forward requests to')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of server processes sharing the port')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Log every packet that is received or sent')
     args = parser.parse_args()
+    logging.basicConfig(format='%(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
     if args.resolver:
         ip, port = args.resolver.rsplit(':', 1)
         resolver = (ip, int(port))
     else:
         resolver = None
+    address = ('127.0.0.1', 2053)
 
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.bind(("127.0.0.1", 2053))
-
-    open_requests = set()
-    subrequests = {}
+    if args.workers <= 1:
+        _serve(address, resolver, reuse_port=False)
+        return
 
-    while True:
-        try:
-            buf, source = udp_socket.recvfrom(512)
-            open_request = None
-
-            incoming, bytes_used = dns.Packet.unpack(buf)
-            print(f'Received packet from {source} of {len(buf)} bytes '
-                  f'and parsed {bytes_used} bytes')
-
-            if source == resolver:
-                # If this packet came from our upstream resolver, then add its results
-                # to our combined results for the original request.
-                response = incoming
-                print('FORWARDED RESPONSE')
-                print('==================')
-                response.print(indent_level=1)
-                print()
-
-                try:
-                    open_request = subrequests.pop(response.header.packet_identifier)
-                except KeyError:
-                    print('Received invalid packet from forwarded resolver')
-                    continue
-
-                open_request.add_response(response)
-            else:
-                # If this packet isn't from our upstream resolver, it's a real request
-                # to resolve an address, so add it to our tracking.
-                request = incoming
-                print('REQUEST')
-                print('=======')
-                request.print(indent_level=1)
-                print()
-
-                open_request = OpenRequest(source, request)
-                open_requests.add(open_request)
-
-                if resolver is not None:
-                    # If we have an upstream resolver configured, then forward the
-                    # request one question at a time.
-                    for question in request.questions:
-                        id = random.randrange(2**16 - 1)
-                        subrequests[id] = open_request
-                        packet = dns.Packet(
-                            header=dataclasses.replace(request.header,
-                                                       packet_identifier=id),
-                            questions=(question, ),
-                            auto_set_header=True,
-                        )
-                        print('FORWARDED REQUEST')
-                        print('=================')
-                        packet.print(indent_level=1)
-                        print()
-                        udp_socket.sendto(packet.pack(), resolver)
-                else:
-                    # If no upstream resolver is configured, then add default answers.
-                    for i, question in enumerate(open_request.request.questions):
-                        open_request.answers[question] = dns.ResourceRecord(
-                            question.name,
-                            dns.AnswerType.A,
-                            dns.AnswerClass.IN,
-                            123 + 10 * i,
-                            b'\x01\x02\x03\x04')
-
-            if open_request is not None and open_request.is_complete:
-                response = open_request.to_response()
-                print('RESPONSE')
-                print('========')
-                response.print(indent_level=1)
-                print()
-
-                udp_socket.sendto(response.pack(), open_request.source)
-                open_requests.remove(open_request)
-        except Exception as e:
-            print(f"Error receiving data: {e}")
-            import traceback
-            traceback.print_exception(e)
-            break
+    # Each worker has its own socket bound to the same port (so the kernel spreads
+    # clients between them) and its own upstream socket, so they share no state.
+    workers = [multiprocessing.Process(target=_serve, args=(address, resolver, True))
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == "__main__":
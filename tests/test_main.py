@@ -1,10 +1,43 @@
 """Test for the DNS server."""
 
+import dataclasses
 import re
+import socket
+import time
 
 import pytest
 
-from app import dns
+from app import dns, main
+
+
+@dataclasses.dataclass(kw_only=True)
+class Unaligned(dns.BitField):
+    first: int = dns.bit_field(3)
+    second: int = dns.bit_field(7)
+
+
+def test_bit_field_unaligned():
+    assert Unaligned.total_bytes == 2
+    value = Unaligned(first=0b101, second=0b1100110)
+    assert value.pack() == b'\xb9\x80'
+    assert Unaligned.unpack(b'\x42\xb9\x80', 1) == (value, 3)
+    value = Unaligned(first=0b010, second=0b0011001)
+    assert value.pack() == b'\x46\x40'
+    assert Unaligned.unpack(b'\x46\x40', 0) == (value, 2)
+    with pytest.raises(ValueError,
+                       match=re.escape('second (128) is out of bounds [0, 127]')):
+        Unaligned(first=0, second=128)
+    with pytest.raises(ValueError,
+                       match=re.escape('first (-1) is out of bounds [0, 7]')):
+        Unaligned(first=-1, second=0)
+
+
+def test_bit_field_missing_width():
+    with pytest.raises(TypeError, match='second is not annotated with bit field width'):
+        @dataclasses.dataclass
+        class Missing(dns.BitField):
+            first: int = dns.bit_field(3)
+            second: int = 0
 
 
 def test_dns_header_size():
@@ -66,6 +99,11 @@ def test_dns_header_packing():
                         answer_record_count=23, authority_record_count=42,
                         additional_record_count=108)
     assert header.pack() == b'\x00\x04\xc2\x8f\x00\x10\x00\x17\x00\x2a\x00\x6c'
+    # Unset fields default to zero when packing without a Header.
+    assert dns.pack_header(4, query_response=1, operation_code=8, truncation=1,
+                           recursion_available=1, response_code=15, question_count=16,
+                           answer_record_count=23, authority_record_count=42,
+                           additional_record_count=108) == header.pack()
 
 
 @pytest.mark.parametrize('start_offset', [0, 10])
@@ -106,6 +144,17 @@ def test_dns_header_unpacking(start_offset):
     assert offset == start_offset + 12
 
 
+def test_dns_header_all_flags():
+    header = dns.Header(packet_identifier=4, query_response=1, operation_code=8,
+                        authoritative_answer=1, truncation=1, recursion_desired=0,
+                        recursion_available=1, reserved=5, response_code=15,
+                        question_count=16, answer_record_count=23,
+                        authority_record_count=42, additional_record_count=108)
+    buf = b'\x00\x04\xc6\xdf\x00\x10\x00\x17\x00\x2a\x00\x6c'
+    assert header.pack() == buf
+    assert dns.Header.unpack(buf, 0) == (header, 12)
+
+
 def test_label_sequence_invalid():
     with pytest.raises(ValueError, match=r'.*longer than 63.*'):
         dns.LabelSequence([b'A' * 200])
@@ -117,6 +166,8 @@ def test_label_sequence_invalid():
         dns.LabelSequence([b'foo0-'])
     with pytest.raises(ValueError, match=r'.*does not obey DNS rules'):
         dns.LabelSequence([b'f!o0'])
+    with pytest.raises(ValueError, match=r"b'f!o' does not obey DNS rules"):
+        dns.LabelSequence([b'foo', b'f!o'])
 
 
 def test_label_sequence_packing():
@@ -133,6 +184,22 @@ def test_label_sequence_unpacking(start_offset):
     name, offset = dns.LabelSequence.unpack(b'\x42' * start_offset + buf, start_offset)
     assert name == (b'codecrafters', b'io')
     assert offset == start_offset + len(buf)
+    assert name.pack() == buf
+
+
+def test_label_sequence_unpacking_not_validated():
+    # Names received from the network are accepted as-is.
+    name, offset = dns.LabelSequence.unpack(b'\x04_tcp\x00', 0)
+    assert name == (b'_tcp', )
+    assert offset == 6
+
+
+def test_label_sequence_unpacking_interned():
+    first, _ = dns.LabelSequence.unpack(b'\x06google\x03com\x00', 0)
+    # The same name from another buffer, and via a pointer, is the same object.
+    second, _ = dns.LabelSequence.unpack(b'\x42\x06google\x03com\x00\xc0\x01', 13)
+    assert type(first) is dns.LabelSequence
+    assert second is first
 
 
 def test_label_sequence_invalid_compression():
@@ -142,6 +209,8 @@ def test_label_sequence_invalid_compression():
         dns.LabelSequence.unpack(b'\x40\x00', 0)
     with pytest.raises(ValueError, match='Label sequence contains a loop'):
         dns.LabelSequence.unpack(b'\xc0\x00', 0)
+    with pytest.raises(ValueError, match='Label sequence contains a loop'):
+        dns.LabelSequence.unpack(b'\x01a\xc0\x04\x01b\xc0\x00', 0)
     with pytest.raises(ValueError,
                        match=r'Label pointer \(66\) exceeds buffer size \(2\)'):
         dns.LabelSequence.unpack(b'\xc0\x42', 0)
@@ -163,6 +232,23 @@ def test_label_sequence_compression():
     ]
 
 
+def test_label_sequence_compression_memo():
+    buf = b'\x42' * 20 + b'\x01F\x03ISI\x04ARPA\x00\03FOO\xc0\x14\xc0\x1a\x00'
+    memo = {}
+    name, offset = dns.LabelSequence.unpack(buf, 20, memo)
+    assert name == (b'F', b'ISI', b'ARPA')
+    assert memo == {
+        20: (b'F', b'ISI', b'ARPA'),
+        22: (b'ISI', b'ARPA'),
+        26: (b'ARPA', ),
+    }
+    # Pointers are resolved from the memo instead of the buffer.
+    memo[20] = (b'BAR', )
+    name, offset = dns.LabelSequence.unpack(buf, offset, memo)
+    assert name == (b'FOO', b'BAR')
+    assert offset == 38
+
+
 def test_question_packing():
     question = dns.Question(dns.LabelSequence([b'google', b'com']),
                             dns.QuestionType.A,
@@ -185,6 +271,17 @@ def test_question_unpacking(start_offset):
     assert offset == start_offset + len(buf)
 
 
+def test_question_unpacking_unknown_type():
+    # HTTPS records (type 65) are not listed in QuestionType.
+    buf = b'\x0ccodecrafters\x02io\x00\x00\x41\x00\x01'
+    question, offset = dns.Question.unpack(buf, 0)
+    assert question.qtype == 65
+    assert question.qclass_enum == dns.QuestionClass.IN
+    with pytest.raises(ValueError):
+        question.qtype_enum
+    assert question.pack() == buf
+
+
 def test_resource_record_packing():
     rr = dns.ResourceRecord(
         dns.LabelSequence([b'codecrafters', b'io']),
@@ -209,3 +306,363 @@ def test_resource_record_unpacking(start_offset):
     assert rr.ttl == 60
     assert rr.data == b'\x08\x08\x08\x08'
     assert offset == start_offset + len(buf)
+
+
+def test_resource_record_unpacking_large_ttl():
+    buf = (
+        b'\x0ccodecrafters\x02io\x00\x00\x01\x00\x01\xff\xff\xff\xff\x00\x04'
+        b'\x08\x08\x08\x08')
+    rr, _ = dns.ResourceRecord.unpack(buf, 0)
+    assert rr.ttl == 2**32 - 1
+    # The unpacked record must pass its own validation, and pack back the same.
+    assert dataclasses.replace(rr) == rr
+    assert rr.pack() == buf
+
+
+def test_packet_unpacking():
+    header = dns.Header(packet_identifier=1234, query_response=1, operation_code=0,
+                        authoritative_answer=0, truncation=0, recursion_desired=1,
+                        recursion_available=0, response_code=0, question_count=1,
+                        answer_record_count=2)
+    buf = (
+        header.pack() +
+        b'\x0ccodecrafters\x02io\x00\x00\x01\x00\x01' +
+        b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04\x08\x08\x08\x08' +
+        b'\x03www\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04\x01\x02\x03\x04')
+    packet, offset = dns.Packet.unpack(buf)
+    assert offset == len(buf)
+    assert packet.header == header
+    name = (b'codecrafters', b'io')
+    assert packet.questions == (
+        dns.Question(dns.LabelSequence(name), dns.QuestionType.A, dns.QuestionClass.IN),
+    )
+    assert packet.answers == (
+        dns.ResourceRecord(dns.LabelSequence(name), dns.AnswerType.A,
+                           dns.AnswerClass.IN, 60, b'\x08\x08\x08\x08'),
+        dns.ResourceRecord(dns.LabelSequence((b'www', *name)), dns.AnswerType.A,
+                           dns.AnswerClass.IN, 60, b'\x01\x02\x03\x04'),
+    )
+    assert all(type(label) is bytes for label in packet.answers[1].name)
+    assert type(packet.answers[1].data) is bytes
+
+
+@pytest.mark.parametrize('size', [5, 20, 30, 40, 46, 48])
+def test_packet_unpacking_truncated(size):
+    header = dns.Header(packet_identifier=1234, query_response=1, operation_code=0,
+                        authoritative_answer=0, truncation=0, recursion_desired=1,
+                        recursion_available=0, response_code=0, question_count=1,
+                        answer_record_count=1)
+    buf = (
+        header.pack() +
+        b'\x0ccodecrafters\x02io\x00\x00\x01\x00\x01' +
+        b'\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04\x08\x08\x08\x08')
+    with pytest.raises(dns.ParseError):
+        dns.Packet.unpack(buf[:size])
+
+
+@pytest.mark.parametrize('operation_code', [0, 2])
+def test_open_request_pack_response(operation_code):
+    header = dns.Header(packet_identifier=1234, query_response=0,
+                        operation_code=operation_code, authoritative_answer=0,
+                        truncation=0, recursion_desired=1, recursion_available=0,
+                        response_code=0)
+    question = dns.Question(dns.LabelSequence([b'codecrafters', b'io']),
+                            dns.QuestionType.A, dns.QuestionClass.IN)
+    request = dns.Packet(header=header, questions=(question, ), auto_set_header=True)
+    open_request = main.OpenRequest(('127.0.0.1', 5353), request)
+    assert not open_request.is_complete
+    with pytest.raises(ValueError, match='Cannot convert open request to response'):
+        open_request.pack_response()
+
+    answer = dns.ResourceRecord(question.name, dns.AnswerType.A, dns.AnswerClass.IN,
+                                60, b'\x08\x08\x08\x08')
+    open_request.add_answers(0, (answer, ))
+    assert open_request.is_complete
+    assert open_request.pack_response() == open_request.to_response().pack()
+
+    echoing_request = main.OpenRequest(('127.0.0.1', 5353), request,
+                                       question_section=question.pack())
+    echoing_request.add_answers(0, (answer, ))
+    assert echoing_request.pack_response() == open_request.pack_response()
+
+
+def test_open_request_add_response():
+    header = dns.Header(packet_identifier=1234, query_response=0, operation_code=0,
+                        authoritative_answer=0, truncation=0, recursion_desired=1,
+                        recursion_available=0, response_code=0)
+    name = dns.LabelSequence([b'codecrafters', b'io'])
+    questions = (dns.Question(name, dns.QuestionType.A, dns.QuestionClass.IN),
+                 dns.Question(name, 65, dns.QuestionClass.CH),
+                 dns.Question(name, dns.QuestionType.MX, dns.QuestionClass.IN))
+    request = dns.Packet(header=header, questions=questions, auto_set_header=True)
+    open_request = main.OpenRequest(('127.0.0.1', 5353), request)
+
+    # Responses may arrive in any order, and may have no answers at all.
+    for index in [1, 2, 0]:
+        question = questions[index]
+        answers = tuple(
+            dns.ResourceRecord(name, question.qtype, question.qclass, 60, b'')
+            for _ in range(index != 2))
+        response = dns.Packet(
+            header=dataclasses.replace(header, query_response=1),
+            questions=(question, ), answers=answers, auto_set_header=True)
+        assert not open_request.is_complete
+        open_request.add_response(index, response)
+    assert open_request.is_complete
+    assert [answer.aclass for answer in open_request.to_response().answers] == [
+        dns.AnswerClass.IN, dns.AnswerClass.CH]
+
+
+@pytest.mark.parametrize('operation_code', [0, 2])
+def test_default_response(operation_code):
+    header = dns.Header(packet_identifier=1234, query_response=0,
+                        operation_code=operation_code, authoritative_answer=0,
+                        truncation=0, recursion_desired=1, recursion_available=0,
+                        response_code=0)
+    questions = tuple(
+        dns.Question(dns.LabelSequence([label, b'codecrafters', b'io']),
+                     dns.QuestionType.A, dns.QuestionClass.IN)
+        for label in [b'abc', b'def'])
+    request = dns.Packet(header=header, questions=questions, auto_set_header=True)
+
+    # The directly packed response must match one built from resource records.
+    open_request = main.OpenRequest(('127.0.0.1', 5353), request)
+    for i, question in enumerate(questions):
+        open_request.add_answers(i, (dns.ResourceRecord(
+            question.name, dns.AnswerType.A, dns.AnswerClass.IN, 123 + 10 * i,
+            b'\x01\x02\x03\x04'), ))
+    assert main._pack_default_response(request) == open_request.pack_response()
+    # Echoing the question section must not change the response.
+    question_section = request.pack()[dns.Header.total_bytes:]
+    assert (main._pack_default_response(request, question_section) ==
+            open_request.pack_response())
+
+
+def _unused_address():
+    """Get a loopback address that nothing is listening on."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()
+
+
+def _make_query(packet_identifier, *names):
+    header = dns.Header(packet_identifier=packet_identifier, query_response=0,
+                        operation_code=0, authoritative_answer=0, truncation=0,
+                        recursion_desired=1, recursion_available=0, response_code=0)
+    questions = tuple(dns.Question(dns.LabelSequence(name), dns.QuestionType.A,
+                                   dns.QuestionClass.IN)
+                      for name in names)
+    return dns.Packet(header=header, questions=questions, auto_set_header=True)
+
+
+def _make_client():
+    """Make a client socket on the loopback interface."""
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(('127.0.0.1', 0))
+    client.settimeout(2)
+    return client
+
+
+def test_server_default_round_trip():
+    server = main.Server(('127.0.0.1', 0))
+    client = _make_client()
+    try:
+        # The second name is compressed, pointing into the first question.
+        questions = (b'\x0ccodecrafters\x02io\x00\x00\x01\x00\x01'
+                     b'\x03abc\xc0\x0c\x00\x01\x00\x01')
+        query = _make_query(1234, [b'codecrafters', b'io'])
+        header = dataclasses.replace(query.header, question_count=2)
+        client.sendto(header.pack() + questions, server.socket.getsockname())
+        server.handle_events(1)
+
+        buf = client.recv(512)
+        response, _ = dns.Packet.unpack(buf)
+        assert response.header.packet_identifier == 1234
+        assert response.header.query_response == 1
+        assert response.header.response_code == 0
+        # The questions are echoed as they were received.
+        assert buf[dns.Header.total_bytes:][:len(questions)] == questions
+        assert [answer.name for answer in response.answers] == [
+            dns.LabelSequence([b'codecrafters', b'io']),
+            dns.LabelSequence([b'abc', b'codecrafters', b'io'])]
+        assert [answer.data for answer in response.answers] == [
+            b'\x01\x02\x03\x04'] * 2
+    finally:
+        client.close()
+        server.close()
+
+
+def test_server_drops_malformed_packet():
+    server = main.Server(('127.0.0.1', 0))
+    client = _make_client()
+    try:
+        address = server.socket.getsockname()
+        query = _make_query(1, [b'codecrafters', b'io'])
+        client.sendto(query.pack()[:20], address)
+        client.sendto(_make_query(2, [b'google', b'com']).pack(), address)
+        time.sleep(0.1)
+        # Both are received in one batch, which continues past the malformed packet.
+        server.handle_events(1)
+
+        response, _ = dns.Packet.unpack(client.recv(512))
+        assert response.header.packet_identifier == 2
+        client.settimeout(0.1)
+        with pytest.raises(TimeoutError):
+            client.recv(512)
+    finally:
+        client.close()
+        server.close()
+
+
+def test_server_forwarded_round_trip():
+    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    upstream.bind(('127.0.0.1', 0))
+    upstream.settimeout(2)
+    server = main.Server(('127.0.0.1', 0), upstream.getsockname())
+    client = _make_client()
+    try:
+        query = _make_query(1234, [b'codecrafters', b'io'], [b'google', b'com'])
+        client.sendto(query.pack(), server.socket.getsockname())
+        server.handle_events(1)
+
+        # Each question is forwarded separately.
+        forwarded = []
+        for _ in query.questions:
+            buf, source = upstream.recvfrom(512)
+            forwarded.append(dns.Packet.unpack(buf)[0])
+        assert sorted(len(packet.questions) for packet in forwarded) == [1, 1]
+        assert {packet.questions[0] for packet in forwarded} == set(query.questions)
+        assert len({packet.header.packet_identifier for packet in forwarded}) == 2
+
+        # Answers are returned in question order, whatever order they arrive in.
+        forwarded.sort(key=lambda packet: query.questions.index(packet.questions[0]))
+        for packet in reversed(forwarded):
+            question = packet.questions[0]
+            answer = dns.ResourceRecord(question.name, dns.AnswerType.A,
+                                        dns.AnswerClass.IN, 60, bytes(4))
+            reply = dns.Packet(
+                header=dataclasses.replace(packet.header, query_response=1),
+                questions=packet.questions, answers=(answer, ), auto_set_header=True)
+            upstream.sendto(reply.pack(), source)
+        while server.open_requests:
+            server.handle_events(1)
+
+        response, _ = dns.Packet.unpack(client.recv(512))
+        assert response.header.packet_identifier == 1234
+        assert response.header.response_code == 0
+        assert response.questions == query.questions
+        assert [answer.name for answer in response.answers] == [
+            question.name for question in query.questions]
+        assert server.subrequests == {}
+    finally:
+        client.close()
+        server.close()
+        upstream.close()
+
+
+def test_server_unreachable_upstream():
+    server = main.Server(('127.0.0.1', 0), _unused_address(), upstream_timeout=0.5)
+    client = _make_client()
+    try:
+        address = server.socket.getsockname()
+        # The first question is forwarded, and refused as nothing is listening.
+        client.sendto(_make_query(1, [b'codecrafters', b'io']).pack(), address)
+        time.sleep(0.1)
+        server.receive(server.socket, server.handle_request)
+        time.sleep(0.1)
+        # That refusal is reported when forwarding the next question, which is still
+        # sent, instead of being blamed for the refusal.
+        client.sendto(_make_query(2, [b'google', b'com']).pack(), address)
+        time.sleep(0.1)
+        server.receive(server.socket, server.handle_request)
+        assert len(server.subrequests) == 2
+        assert len(server.open_requests) == 2
+        time.sleep(0.1)
+        # The refusal of the second question is reported when receiving instead.
+        server.receive(server.upstream, server.handle_upstream_response)
+        assert len(server.subrequests) == 2
+
+        # Both requests fail once their questions time out.
+        while server.open_requests:
+            server.handle_events(1)
+        responses = [dns.Packet.unpack(client.recv(512))[0] for _ in range(2)]
+        assert [response.header.packet_identifier for response in responses] == [1, 2]
+        assert all(response.header.response_code == 2 for response in responses)
+        assert all(response.answers == () for response in responses)
+        assert server.subrequests == {}
+    finally:
+        client.close()
+        server.close()
+
+
+class _FullSocket:
+    """A stand-in for a socket whose send buffer is full."""
+
+    def __init__(self):
+        self.attempts = 0
+
+    def sendto(self, data, address):
+        self.attempts += 1
+        raise BlockingIOError(11, 'Resource temporarily unavailable')
+
+
+def test_server_drops_unsendable_response(caplog):
+    server = main.Server(('127.0.0.1', 0))
+    sock = server.socket
+    try:
+        server.socket = _FullSocket()
+        query = _make_query(1, [b'codecrafters', b'io'])
+        wire = memoryview(query.pack())
+        assert server.handle_request(query, ('127.0.0.1', 1234), wire) is None
+        assert server.socket.attempts == 1
+        assert 'Dropping response' in caplog.text
+    finally:
+        server.socket = sock
+        server.close()
+
+
+def test_server_upstream_timeout():
+    # An upstream resolver that never answers.
+    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    upstream.bind(('127.0.0.1', 0))
+    server = main.Server(('127.0.0.1', 0), upstream.getsockname(),
+                         upstream_timeout=0.1)
+    client = _make_client()
+    try:
+        query = _make_query(1, [b'codecrafters', b'io'], [b'google', b'com'])
+        client.sendto(query.pack(), server.socket.getsockname())
+        server.handle_events(1)
+        assert len(server.subrequests) == 2
+        # Waiting for packets wakes up in time to expire the forwarded questions.
+        start = time.monotonic()
+        server.handle_events(1)
+        assert time.monotonic() - start < 0.5
+        response, _ = dns.Packet.unpack(client.recv(512))
+        assert response.header.packet_identifier == 1
+        assert response.header.response_code == 2
+        assert server.subrequests == {}
+        assert server.open_requests == {}
+    finally:
+        client.close()
+        server.close()
+        upstream.close()
+
+
+def test_server_no_free_packet_identifier(monkeypatch):
+    server = main.Server(('127.0.0.1', 0), _unused_address())
+    monkeypatch.setattr(main.random, 'getrandbits', lambda bits: 7)
+    try:
+        source = ('127.0.0.1', 1234)
+        first = _make_query(1, [b'codecrafters', b'io'])
+        open_request = server.handle_request(first, source, memoryview(first.pack()))
+        assert not open_request.is_complete
+        assert list(server.subrequests) == [7]
+
+        # Every identifier drawn is in flight, so the question cannot be forwarded.
+        second = _make_query(2, [b'google', b'com'])
+        open_request = server.handle_request(second, source, memoryview(second.pack()))
+        assert open_request.is_complete
+        assert open_request.to_response().header.response_code == 2
+        assert list(server.subrequests) == [7]
+    finally:
+        server.close()